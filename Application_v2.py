@@ -9,20 +9,37 @@ import io
 import os
 import json
 import gzip
+import multiprocessing
 import zipfile
 import base64
+import bisect
+import functools
+import pickle
+import sys
+import tempfile
 import traceback
-import xml.etree.ElementTree as ET
-from typing import Dict, Tuple
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 import streamlit as st
 
+from netex_parser import NETEX_TAG_PREFIX, PARSE_FAILED, _parse_one, _root_tag, parse_netex
+
+# python-calamine (Rust) reads xlsx ~10x faster than openpyxl; optional, and
+# pandas only knows the "calamine" engine from 2.2 on
+try:
+    import python_calamine  # noqa: F401
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
+else:
+    _pandas_version = tuple(int(part) for part in pd.__version__.split(".")[:2])
+    EXCEL_ENGINE = "calamine" if _pandas_version >= (2, 2) else "openpyxl"
+
 # Google libs
 try:
     from google.oauth2 import service_account
     from googleapiclient.discovery import build
-    from googleapiclient.http import MediaIoBaseDownload
+    from google.auth.transport.requests import AuthorizedSession
 except Exception as e:
     # We'll show a helpful error in the UI rather than crash at import time
     _google_import_error = e
@@ -33,130 +50,231 @@ else:
 # CONFIG
 # --------------------------
 ZIP_FILE_NAME_ON_DRIVE = "Fares.zip"
+# parsed copies of Fares.zip, keyed by the Drive md5Checksum
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".fare_finder_cache")
+# bump when the shape of the parsed data changes, so stale pickles are ignored
+PARSE_CACHE_VERSION = 3
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
+DRIVE_MEDIA_URL = "https://www.googleapis.com/drive/v3/files/{file_id}"
+DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+# the ZIP stays in memory up to this size, then spills to a temp file
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+# Stops sheet columns, by position (the header text varies between exports)
+STOPS_SERVICE_COL = 0
+STOPS_STAGE_COL = 1
+STOPS_PLACE_COL = 7
+# fare types offered under another name in the UI
+FARE_TYPE_ALIASES = {"U19 MySingle": "U19 Single", "igo Single": "U19 Single"}
 
 # --------------------------
-# NETEX parsing (same logic as your script)
-# --------------------------
-def parse_netex(xml_path_or_filelike) -> Tuple[Dict[str, str], Dict[tuple, str]]:
-    try:
-        if isinstance(xml_path_or_filelike, (bytes, bytearray)):
-            fh = io.BytesIO(xml_path_or_filelike)
-            tree = ET.parse(fh)
-        elif hasattr(xml_path_or_filelike, "read"):
-            tree = ET.parse(xml_path_or_filelike)
-        else:
-            tree = ET.parse(xml_path_or_filelike)
-        root = tree.getroot()
-    except Exception:
-        # try bytes fallback
-        if isinstance(xml_path_or_filelike, (bytes, bytearray)):
-            fh = io.BytesIO(xml_path_or_filelike)
-            tree = ET.parse(fh)
-            root = tree.getroot()
-        else:
-            raise
-
-    ns = {"n": "http://www.netex.org.uk/netex"}
-
-    zone_lookup = {}
-    for fz in root.findall(".//n:FareZone", ns):
-        fz_id = fz.attrib.get("id")
-        name_elem = fz.find("n:Name", ns)
-        if fz_id and name_elem is not None and name_elem.text:
-            zone_lookup[fz_id] = name_elem.text.strip()
-
-    price_lookup = {}
-    for pg in root.findall(".//n:PriceGroup", ns):
-        pg_id = pg.attrib.get("id")
-        amount_elem = pg.find(".//n:GeographicalIntervalPrice/n:Amount", ns)
-        if pg_id and amount_elem is not None and amount_elem.text:
-            try:
-                price_lookup[pg_id] = f"{float(amount_elem.text.strip()):.2f}"
-            except Exception:
-                continue
-
-    fares = {}
-    for dme in root.findall(".//n:DistanceMatrixElement", ns):
-        start_elem = dme.find("n:StartTariffZoneRef", ns)
-        end_elem = dme.find("n:EndTariffZoneRef", ns)
-        price_ref_elem = dme.find("n:priceGroups/n:PriceGroupRef", ns)
-        if start_elem is None or end_elem is None or price_ref_elem is None:
-            continue
-        start = start_elem.attrib.get("ref")
-        end = end_elem.attrib.get("ref")
-        price_ref = price_ref_elem.attrib.get("ref")
-        price = price_lookup.get(price_ref)
-        if start and end and price is not None:
-            fares[(start, end)] = price
-    return zone_lookup, fares
-
-# --------------------------
-# Drive helpers (download ZIP into memory)
+# Drive helpers (download ZIP into a spooled temp file)
 # --------------------------
 def get_drive_service_from_info(sa_info: dict):
+    """Returns (service, credentials); the credentials are reused for the media download."""
     creds = service_account.Credentials.from_service_account_info(sa_info, scopes=SCOPES)
     service = build("drive", "v3", credentials=creds, cache_discovery=False)
-    return service
+    return service, creds
 
 def find_file_by_name(service, name):
-    q = f"""name = '{name.replace("'", "\\'")}' and trashed = false"""
-    resp = service.files().list(q=q, pageSize=10, fields="files(id, name, mimeType)").execute()
+    """Returns the Drive file dict, md5Checksum included so the parse cache can be checked without another call."""
+    escaped = name.replace("'", "\\'")
+    q = f"name = '{escaped}' and trashed = false"
+    # only the first match is used, and only its id and checksum
+    resp = service.files().list(
+        q=q, spaces="drive", pageSize=1, fields="files(id, md5Checksum)"
+    ).execute()
     files = resp.get("files", [])
     if not files:
         return None
     return files[0]
 
-def download_file_bytes(service, file_id):
-    request = service.files().get_media(fileId=file_id)
-    fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while not done:
-        status, done = downloader.next_chunk()
-    fh.seek(0)
-    return fh.read()
+def download_file_spooled(creds, file_id):
+    """
+    Download a Drive file into a SpooledTemporaryFile, rewound and ready to read.
+    One streamed alt=media request (AuthorizedSession refreshes the token)
+    instead of a ranged request per MediaIoBaseDownload chunk.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        with AuthorizedSession(creds) as session:
+            with session.get(DRIVE_MEDIA_URL.format(file_id=file_id), params={"alt": "media"}, stream=True) as resp:
+                resp.raise_for_status()
+                for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    spool.write(chunk)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+def get_file_metadata(service, file_id):
+    return service.files().get(fileId=file_id, fields="id,md5Checksum,modifiedTime").execute()
+
+# --------------------------
+# Local parse cache (skip download + parse when Fares.zip is unchanged)
+# --------------------------
+def _cache_path(md5):
+    return os.path.join(CACHE_DIR, f"{md5}-v{PARSE_CACHE_VERSION}.pkl")
+
+def load_parsed_from_cache(md5):
+    path = _cache_path(md5)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as fh:
+            return pickle.load(fh)
+    except Exception:
+        traceback.print_exc()
+        return None
+
+def save_parsed_to_cache(md5, parsed, routes_df, stops_df):
+    tmp = None
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fh:
+            pickle.dump((parsed, routes_df, stops_df), fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, _cache_path(md5))
+        tmp = None
+        # only the current ZIP is worth keeping
+        for name in os.listdir(CACHE_DIR):
+            if name.endswith(".pkl") and name != os.path.basename(_cache_path(md5)):
+                os.remove(os.path.join(CACHE_DIR, name))
+    except Exception:
+        traceback.print_exc()
+    finally:
+        # a half-written temp file would never be pruned (only *.pkl is)
+        if tmp is not None:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
 
 # --------------------------
 # ZIP in-memory loader - returns parsed dict and DataFrames
 # --------------------------
-def load_from_fares_zip_bytes(zip_bytes: bytes):
+def read_excel(source):
+    # pandas already opens openpyxl workbooks read-only/data-only
+    return pd.read_excel(source, engine=EXCEL_ENGINE)
+
+def read_excel_member(zf, name):
+    # read the workbook straight from the archive member, without an
+    # intermediate bytes copy
+    with zf.open(name) as fh:
+        return read_excel(fh)
+
+def _skip_non_netex(name, fh):
+    """
+    True (and logged) when the document in fh has a root element outside the
+    NeTEx namespace. A root that can't be read proves nothing, so that member
+    still goes to the parser. fh is rewound either way.
+    """
+    tag = _root_tag(fh)
+    fh.seek(0)
+    if tag is None or tag.startswith(NETEX_TAG_PREFIX):
+        return False
+    print(f"Skipping {name}: root element {tag} is not NeTEx", file=sys.stderr)
+    return True
+
+def _parse_member(zf, name):
+    # inline path: stream the member straight into the parser, no bytes copy
+    try:
+        with zf.open(name) as fh:
+            if _skip_non_netex(name, fh):
+                return None
+            return parse_netex(fh)
+    except Exception:
+        traceback.print_exc()
+        return PARSE_FAILED
+
+def _read_members(zf, names, failed):
+    # lazily, so each member is decompressed only once the previous ones are on their way to the pool
+    for name in names:
+        try:
+            data = zf.read(name)
+        except Exception:
+            traceback.print_exc()
+            failed.append(name)
+            yield None
+        else:
+            # other XML in the archive is skipped rather than sent to a worker
+            yield None if _skip_non_netex(name, io.BytesIO(data)) else data
+
+# Workers never fork this (multi-threaded) server process directly: they come
+# from a forkserver where there is one, else the platform's default start
+# method. multiprocessing still re-runs this script in each worker, as
+# "__mp_main__", which is why the UI only runs from main() below; preloading
+# the parser and the script's heavy imports in the forkserver makes that cheap.
+if "forkserver" in multiprocessing.get_all_start_methods():
+    POOL_CONTEXT = multiprocessing.get_context("forkserver")
+    POOL_CONTEXT.set_forkserver_preload(["netex_parser", "pandas", "streamlit"])
+else:
+    POOL_CONTEXT = multiprocessing.get_context()
+
+def parse_xml_entries(zf, names):
+    """
+    Parse the XML members `names` of zf in parallel. Returns (results, failed):
+    results in input order, None for members that were skipped or failed, and
+    the names of the members that could not be read or parsed. Members are
+    decompressed on this thread while the workers parse the ones already
+    submitted; a single member, or a pool that breaks, is parsed straight from
+    the archive.
+    """
+    if len(names) > 1:
+        try:
+            with ProcessPoolExecutor(
+                max_workers=min(os.cpu_count() or 1, len(names)), mp_context=POOL_CONTEXT
+            ) as ex:
+                failed = []
+                results = list(ex.map(_parse_one, _read_members(zf, names, failed), chunksize=4))
+        except Exception:
+            # the pool broke (e.g. a worker died) - parse inline instead
+            traceback.print_exc()
+        else:
+            return _collect_failures(names, results, failed)
+    return _collect_failures(names, [_parse_member(zf, name) for name in names], [])
+
+def _collect_failures(names, results, failed):
+    failed.extend(name for name, result in zip(names, results) if result == PARSE_FAILED)
+    return [None if result == PARSE_FAILED else result for result in results], failed
+
+def load_from_fares_zip_bytes(zip_source):
+    """
+    zip_source: the ZIP as bytes, or a seekable binary file object.
+    Returns (parsed, routes_df, stops_df, failed), failed naming the XML members
+    that could not be read or parsed.
+    """
     parsed = {}
     routes_df = pd.DataFrame()
     stops_df = pd.DataFrame()
+    xml_entries = []
+    failed = []
 
     try:
-        with zipfile.ZipFile(io.BytesIO(zip_bytes)) as zf:
+        if isinstance(zip_source, (bytes, bytearray)):
+            zip_source = io.BytesIO(zip_source)
+        with zipfile.ZipFile(zip_source) as zf:
             namelist = zf.namelist()
             for name in namelist:
                 if name.endswith("/"):
                     continue
                 basename = os.path.basename(name)
                 low = basename.lower()
-                try:
-                    data = zf.read(name)
-                except Exception:
-                    continue
 
                 if low.endswith(".xml"):
-                    try:
-                        zl, fares = parse_netex(io.BytesIO(data))
-                        key = basename[:-4]
-                        parsed[key] = {"zone_lookup": zl, "fares": fares}
-                    except Exception:
-                        traceback.print_exc()
+                    xml_entries.append((basename[:-4], name))
                     continue
 
                 # spreadsheet heuristics
                 if low == "routes.xlsx" or "routes" == os.path.splitext(low)[0]:
                     try:
-                        routes_df = pd.read_excel(io.BytesIO(data))
+                        routes_df = read_excel_member(zf, name)
                     except Exception:
                         traceback.print_exc()
                     continue
                 if low == "stops.xlsx" or "stops" == os.path.splitext(low)[0]:
                     try:
-                        stops_df = pd.read_excel(io.BytesIO(data))
+                        stops_df = read_excel_member(zf, name)
                     except Exception:
                         traceback.print_exc()
                     continue
@@ -164,24 +282,30 @@ def load_from_fares_zip_bytes(zip_bytes: bytes):
                 # relaxed matches
                 if ("routes" in low) and routes_df.empty:
                     try:
-                        routes_df = pd.read_excel(io.BytesIO(data))
+                        routes_df = read_excel_member(zf, name)
                         continue
                     except Exception:
                         pass
                 if ("stops" in low) and stops_df.empty:
                     try:
-                        stops_df = pd.read_excel(io.BytesIO(data))
+                        stops_df = read_excel_member(zf, name)
                         continue
                     except Exception:
                         pass
+
+            results, failed = parse_xml_entries(zf, [name for _, name in xml_entries])
+        for (key, _), result in zip(xml_entries, results):
+            if result is not None:
+                zl, fares = result
+                parsed[key] = {"zone_lookup": zl, "fares": fares}
     except zipfile.BadZipFile:
         st.error("The downloaded file is not a valid ZIP.")
-        return {}, pd.DataFrame(), pd.DataFrame()
+        return {}, pd.DataFrame(), pd.DataFrame(), []
     except Exception:
         traceback.print_exc()
-        return {}, pd.DataFrame(), pd.DataFrame()
+        return {}, pd.DataFrame(), pd.DataFrame(), []
 
-    return parsed, routes_df, stops_df
+    return parsed, routes_df, stops_df, failed
 
 # --------------------------
 # Embedded excel loader (optional)
@@ -193,674 +317,774 @@ def load_embedded_excel(b64_string):
         decoded = base64.b64decode(b64_string)
         decompressed = gzip.decompress(decoded)
         bio = io.BytesIO(decompressed)
-        return pd.read_excel(bio)
+        return read_excel(bio)
     except Exception:
         traceback.print_exc()
         return pd.DataFrame()
 
+# --------------------------
+# Session-level memoisation
+# --------------------------
+def session_cache(fn):
+    """
+    Like functools.lru_cache(maxsize=None), but the entries live in
+    st.session_state: Streamlit re-executes this script on every interaction,
+    which would throw a module-level cache away. Arguments must be hashable;
+    cached functions read the loaded data from session_state, which only
+    changes through store_loaded_data, which clears every cache at once via
+    _invalidate_caches - there is no per-function clear.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        memo = st.session_state.setdefault("_MEMO", {}).setdefault(fn.__name__, {})
+        key = (args, tuple(sorted(kwargs.items())))
+        if key not in memo:
+            memo[key] = fn(*args, **kwargs)
+        return memo[key]
+    return wrapper
+
+def _invalidate_caches():
+    st.session_state.pop("_MEMO", None)
+
 # --------------------------
 # Helper functions (ported)
 # --------------------------
-def route_files_for(parsed_data, route):
-    keys = sorted(parsed_data.keys())
-    return [k for k in keys if k.startswith(route + " ")]
+def route_files_for(parsed_keys_sorted, route):
+    # keys sharing the "<route> " prefix form one contiguous run of the sorted list
+    prefix = route + " "
+    lo = bisect.bisect_left(parsed_keys_sorted, prefix)
+    hi = lo
+    while hi < len(parsed_keys_sorted) and parsed_keys_sorted[hi].startswith(prefix):
+        hi += 1
+    return parsed_keys_sorted[lo:hi]
 
 def faretype_from_key(route, key):
     if key.startswith(route + " "):
         return key[len(route):].strip()
     return None
 
-def route_name_to_service_code(routes_df, route_name):
-    if routes_df is None or routes_df.empty:
-        return None
-    try:
-        if routes_df.shape[1] >= 2:
-            mask = routes_df.iloc[:, 1].astype(str).str.strip() == route_name
-            matched = routes_df.loc[mask]
-            if not matched.empty:
-                return matched.iloc[0, 0]
-    except Exception:
-        pass
-    return None
-
-def service_code_to_route_name(routes_df, service_code):
-    if routes_df is None or routes_df.empty:
-        return None
-    try:
-        if routes_df.shape[1] >= 2:
-            mask = routes_df.iloc[:, 0].astype(str).str.strip() == str(service_code).strip()
-            matched = routes_df.loc[mask]
-            if not matched.empty:
-                return matched.iloc[0, 1]
-    except Exception:
-        pass
-    return None
-
-def build_place_to_stage_map_for_service(stops_df, service_code):
-    place_to_stage, stage_to_place = {}, {}
-    if stops_df is None or stops_df.empty:
-        return place_to_stage, stage_to_place
-    try:
-        sc_col, stage_col, place_col = stops_df.columns[0], stops_df.columns[1], stops_df.columns[7]
-    except Exception:
-        return place_to_stage, stage_to_place
-    mask = stops_df[sc_col].astype(str).str.strip() == str(service_code).strip()
-    subset = stops_df.loc[mask]
-    for _, row in subset.iterrows():
-        stage, place = str(row[stage_col]).strip(), str(row[place_col]).strip()
-        if not stage or not place:
-            continue
-        place_to_stage.setdefault(place, set()).add(stage)
-        stage_to_place.setdefault(stage, set()).add(place)
-    place_to_stage = {k: sorted(v) for k, v in place_to_stage.items()}
-    stage_to_place = {k: sorted(v) for k, v in stage_to_place.items()}
-    return place_to_stage, stage_to_place
-
-def get_all_places_from_stops(stops_df, routes_df, include_school_services=False):
-    if stops_df is None or stops_df.empty:
-        return []
-    try:
-        place_col = stops_df.columns[7]
-        sc_col = stops_df.columns[0]
-        all_places = stops_df[place_col].dropna().astype(str).str.strip()
-        all_places = sorted([p for p in set(all_places) if p and p.lower() != "nan"])
-        if include_school_services:
-            return all_places
-        if routes_df is None or routes_df.empty or routes_df.shape[1] < 3:
-            return all_places
-        school_col = routes_df.columns[2]
-        non_school_codes = set(
-            routes_df.loc[
-                routes_df[school_col].astype(str).str.lower() != "yes",
-                routes_df.columns[0]
-            ].astype(str)
-        )
-        result = []
-        for place in all_places:
-            services = set(stops_df.loc[stops_df[place_col] == place, sc_col].astype(str).tolist())
-            if services & non_school_codes:
-                result.append(place)
-        return sorted(result)
-    except Exception:
-        traceback.print_exc()
-        return []
-
-def get_reachable_places(stops_df, start_place):
-    if not start_place or stops_df is None or stops_df.empty:
-        return []
-    try:
-        sc_col, place_col = stops_df.columns[0], stops_df.columns[7]
-        services = stops_df.loc[stops_df[place_col] == start_place, sc_col].astype(str)
-        if services.empty:
-            return []
-        subset = stops_df.loc[stops_df[sc_col].astype(str).isin(services)]
-        reachable = set(subset[place_col].dropna().astype(str).str.strip())
-        reachable.discard(start_place)
-        return sorted([p for p in reachable if p and p.lower() != "nan"])
-    except Exception:
-        return []
+def merge_fare_entries(entries):
+    """
+    Merge the zone_lookup and fares of several parsed entries; the first entry
+    to define a zone id, stage name or stage pair wins.
+    Returns (zone_lookup, fares, name_to_id). With a single entry its own dicts
+    are returned rather than copied, so treat the result as read-only.
+    """
+    if len(entries) == 1:
+        lookup = entries[0].get("zone_lookup", {})
+        n2i = dict(zip(reversed(lookup.values()), reversed(lookup.keys())))
+        return lookup, entries[0].get("fares", {}), n2i
+    zl, fdict, n2i = {}, {}, {}
+    # applied back to front so that earlier entries overwrite later ones
+    for entry in reversed(entries):
+        lookup = entry.get("zone_lookup", {})
+        zl.update(lookup)
+        n2i.update(zip(reversed(lookup.values()), reversed(lookup.keys())))
+        fdict.update(entry.get("fares", {}))
+    return zl, fdict, n2i
+
+def build_fare_partners(fares):
+    """
+    zone id -> {other zone id -> price}, both directions, so a fare between two
+    zones is one lookup whichever way round the files store it. A pair stored
+    the right way round wins over its reverse; 0.00 is a valid fare.
+    """
+    partners = {}
+    for (a, b), price in fares.items():
+        partners.setdefault(a, {})[b] = price
+    for (a, b), price in fares.items():
+        row = partners.setdefault(b, {})
+        if a not in row:
+            row[a] = price
+    return partners
+
+def format_price(price):
+    return f"£{price:.2f}"
+
+def route_name_to_service_code(route_name_to_sc, route_name):
+    return route_name_to_sc.get(route_name)
+
+def service_code_to_route_name(sc_to_route_name, service_code):
+    return sc_to_route_name.get(service_code)
+
+def get_place_to_stage_map(service_code):
+    """place -> sorted stage names for one service, from the SERVICE_PLACE_STAGES index (don't mutate it)."""
+    return st.session_state.SERVICE_PLACE_STAGES.get(service_code, {})
+
+@session_cache
+def get_all_places_from_stops(include_school_services=False):
+    place_to_services = st.session_state.PLACE_TO_SERVICES
+    routes_df = st.session_state.ROUTES_DF
+    all_places = tuple(sorted(place_to_services))
+    if include_school_services:
+        return all_places
+    if routes_df is None or routes_df.empty or routes_df.shape[1] < 3:
+        return all_places
+    non_school_services = st.session_state.NON_SCHOOL_SERVICES
+    return tuple(p for p in all_places if place_to_services[p] & non_school_services)
+
+@session_cache
+def get_route_options(include_school_routes=False):
+    """Route names that have at least one fare type, sorted."""
+    routes_df = st.session_state.ROUTES_DF
+    if routes_df is None or routes_df.empty or routes_df.shape[1] < 2:
+        return ()
+    routes_norm = st.session_state.ROUTES_NORM
+    # the first row for a name decides whether it is a school route
+    first_rows = routes_norm[routes_norm["name"] != ""].drop_duplicates("name")
+    if not include_school_routes:
+        first_rows = first_rows[~first_rows["is_school"]]
+    # a route has fare types exactly when it has an entry in ROUTE_FARETYPE_KEYS
+    route_faretype_keys = st.session_state.ROUTE_FARETYPE_KEYS
+    return tuple(sorted(rn for rn in first_rows["name"] if rn in route_faretype_keys))
+
+@session_cache
+def get_reachable_places(start_place):
+    services = st.session_state.PLACE_TO_SERVICES.get(start_place)
+    if not services:
+        return ()
+    service_to_places = st.session_state.SERVICE_TO_PLACES
+    reachable = set().union(*(service_to_places.get(sc, ()) for sc in services))
+    reachable.discard(start_place)
+    return tuple(sorted(reachable))
+
+@session_cache
+def get_merged_fare_tables(matched_keys):
+    """
+    merge_fare_entries over a tuple of PARSED_DATA keys, plus the fares'
+    build_fare_partners index: (zone_lookup, fares, name_to_id, partners).
+    Kept for the session so that reruns for the same route/fare type (e.g.
+    picking a stage) reuse it. The result is shared - treat it as read-only.
+    """
+    parsed = st.session_state.PARSED_DATA
+    zl, fdict, n2i = merge_fare_entries([parsed.get(k, {}) for k in matched_keys])
+    return zl, fdict, n2i, build_fare_partners(fdict)
 
 # --------------------------
-# UI & state
+# Lookup indices (rebuilt whenever new data is loaded)
 # --------------------------
-st.set_page_config(page_title="NeTEx Fare Finder", layout="wide")
-st.title("NeTEx Fare Finder — Streamlit edition")
-st.write("This app downloads `Fares.zip` from your Google Drive (shared with the service account) and provides a fare lookup UI.")
-
-# Show helpful error if google libs not installed
-if _google_import_error:
-    st.error(
-        "Google client libraries are not installed in the environment. "
-        "Install: `google-api-python-client google-auth google-auth-httplib2 google-auth-oauthlib`"
-    )
-    st.exception(_google_import_error)
-    st.stop()
-
-# Provide credential input options
-st.sidebar.header("Authentication")
-st.sidebar.write(
-    "Preferred: store the **service account JSON** in your GitHub repo secrets as "
-    "`GOOGLE_SERVICE_ACCOUNT` (Streamlit reads `st.secrets`)."
-)
-sa_info = None
-
-# Option 1: st.secrets
-if "GOOGLE_SERVICE_ACCOUNT" in st.secrets:
-    try:
-        sa_info = json.loads(st.secrets["GOOGLE_SERVICE_ACCOUNT"])
-        st.sidebar.success("Using GitHub secret: GOOGLE_SERVICE_ACCOUNT")
-    except Exception:
-        st.sidebar.error("Failed to parse st.secrets['GOOGLE_SERVICE_ACCOUNT'] - ensure it contains the raw JSON text.")
-else:
-    st.sidebar.info("No GitHub secret found (GOOGLE_SERVICE_ACCOUNT). You can upload credentials.json or set an env var.")
-    uploaded = st.sidebar.file_uploader("Upload credentials.json (optional)", type=["json"])
-    if uploaded is not None:
-        try:
-            sa_info = json.load(uploaded)
-            st.sidebar.success("Uploaded credentials.json will be used for this session.")
-        except Exception:
-            st.sidebar.error("Uploaded file is not valid JSON.")
+def _normalised_str(series):
+    # missing cells -> "" (astype(str) gives "nan" or keeps NaN depending on the pandas version)
+    return series.where(series.notna(), "").astype(str).str.strip()
 
-# Option: environment variable (useful for other deployments)
-if sa_info is None and os.environ.get("GOOGLE_SERVICE_ACCOUNT"):
-    try:
-        sa_info = json.loads(os.environ["GOOGLE_SERVICE_ACCOUNT"])
-        st.sidebar.success("Using GOOGLE_SERVICE_ACCOUNT environment variable.")
-    except Exception:
-        st.sidebar.error("Failed to parse GOOGLE_SERVICE_ACCOUNT environment variable.")
+def _interned(series):
+    # interned like the parsed zone names, so index lookups against them compare by identity first
+    return list(map(sys.intern, series.tolist()))
 
-# Load / reload controls
-reload_button = st.sidebar.button("Reload data from Drive (force)")
-load_message = st.sidebar.empty()
-
-@st.cache_data(show_spinner=False)
-def load_data_from_drive_cached(sa_info_serialized: str):
+def normalise_routes(routes_df):
     """
-    sa_info_serialized: json string of service account info. Cached by this string.
-    Returns: parsed_data, routes_df, stops_df, message (str)
+    Stripped string copies of the Routes columns the UI filters on (code, name,
+    display number) plus a boolean school flag, aligned to routes_df's index.
+    Kept apart from routes_df so its positional column layout is untouched.
     """
-    parsed = {}
-    routes_df = pd.DataFrame()
-    stops_df = pd.DataFrame()
-    msg = ""
-
-    try:
-        sa_info = json.loads(sa_info_serialized)
-        service = get_drive_service_from_info(sa_info)
-    except Exception as e:
-        msg = f"Drive authentication failed: {e}"
-        return parsed, routes_df, stops_df, msg
-
-    f = find_file_by_name(service, ZIP_FILE_NAME_ON_DRIVE)
-    if not f:
-        msg = f"'{ZIP_FILE_NAME_ON_DRIVE}' not found on Drive root (or not shared with the service account)."
-        return parsed, routes_df, stops_df, msg
-
-    try:
-        zip_bytes = download_file_bytes(service, f["id"])
-    except Exception as e:
-        msg = f"Failed to download ZIP from Drive: {e}"
-        return parsed, routes_df, stops_df, msg
-
-    parsed, routes_df, stops_df = load_from_fares_zip_bytes(zip_bytes)
-    msg = f"Loaded ZIP with {len(parsed)} XML fare files. Routes rows: {len(routes_df)} Stops rows: {len(stops_df)}"
-    return parsed, routes_df, stops_df, msg
-
-# container in session state
-if "PARSED_DATA" not in st.session_state:
-    st.session_state.PARSED_DATA = {}
-if "ROUTES_DF" not in st.session_state:
-    st.session_state.ROUTES_DF = pd.DataFrame()
-if "STOPS_DF" not in st.session_state:
-    st.session_state.STOPS_DF = pd.DataFrame()
-if "LIVE_DATA_LOADED" not in st.session_state:
-    st.session_state.LIVE_DATA_LOADED = False
-
-# Perform load if sa_info is present
-if sa_info is not None:
-    # Use a deterministic cache key (stringified JSON)
-    key = json.dumps(sa_info, sort_keys=True)
-    if reload_button:
-        # clear cache by calling cached fn with a changed key: append timestamp
-        key = key + f"_{st.runtime.scriptrunner.requested_at if hasattr(st.runtime, 'scriptrunner') else ''}"
-    parsed, routes_df, stops_df, msg = load_data_from_drive_cached(key)
+    ncols = 0 if routes_df is None else routes_df.shape[1]
+    if ncols == 0:
+        empty = pd.Series([], dtype=object)
+        return pd.DataFrame({"code": empty, "name": empty, "number": empty, "is_school": pd.Series([], dtype=bool)})
+    blank = pd.Series("", index=routes_df.index, dtype=object)
+    code = _normalised_str(routes_df.iloc[:, 0])
+    name = _normalised_str(routes_df.iloc[:, 1]) if ncols >= 2 else blank
+    number = _normalised_str(routes_df.iloc[:, 3]) if ncols >= 4 else name
+    is_school = (_normalised_str(routes_df.iloc[:, 2]) if ncols >= 3 else blank).str.lower() == "yes"
+    return pd.DataFrame({"code": code, "name": name, "number": number, "is_school": is_school})
+
+def build_lookup_indices(routes_df, stops_df):
+    """
+    Precompute the place/service/route lookups the UI needs on every rerun so
+    that callbacks do dict/set lookups instead of scanning the DataFrames.
+    Returns a dict of session_state name -> index. Codes, places and route
+    names are stripped strings, so lookups take index values as they are.
+    """
+    place_to_services, service_to_places, service_place_stages = {}, {}, {}
+    if stops_df is not None and not stops_df.empty and stops_df.shape[1] > STOPS_PLACE_COL:
+        codes = _normalised_str(stops_df.iloc[:, STOPS_SERVICE_COL])
+        stages = _normalised_str(stops_df.iloc[:, STOPS_STAGE_COL])
+        places = _normalised_str(stops_df.iloc[:, STOPS_PLACE_COL])
+        keep = (codes != "") & (places != "")
+        # plain passes over the columns; much cheaper than a groupby per direction
+        served = keep & (places.str.lower() != "nan")
+        for sc, place in zip(_interned(codes[served]), _interned(places[served])):
+            place_to_services.setdefault(place, set()).add(sc)
+            service_to_places.setdefault(sc, set()).add(place)
+        place_to_services = {k: frozenset(v) for k, v in place_to_services.items()}
+        service_to_places = {k: frozenset(v) for k, v in service_to_places.items()}
+
+        staged = keep & (stages != "")
+        for sc, stage, place in zip(_interned(codes[staged]), _interned(stages[staged]), _interned(places[staged])):
+            service_place_stages.setdefault(sc, {}).setdefault(place, set()).add(stage)
+        service_place_stages = {
+            sc: {place: sorted(names) for place, names in by_place.items()}
+            for sc, by_place in service_place_stages.items()
+        }
+
+    routes_norm = normalise_routes(routes_df)
+    route_name_to_sc, sc_to_route_name = {}, {}
+    if routes_df is not None and routes_df.shape[1] >= 2:
+        pairs = routes_norm[(routes_norm["code"] != "") & (routes_norm["name"] != "")]
+        codes = _interned(pairs["code"])
+        names = _interned(pairs["name"])
+        # built back to front so the first matching row wins, as the old scans did
+        route_name_to_sc = dict(zip(reversed(names), reversed(codes)))
+        sc_to_route_name = dict(zip(reversed(codes), reversed(names)))
+
+    non_school_services = frozenset(routes_norm.loc[~routes_norm["is_school"], "code"])
+    coded = routes_norm[routes_norm["code"] != ""]
+    sc_to_route_number = dict(zip(reversed(coded["code"].tolist()), reversed(coded["number"].tolist())))
+    # every display number a service has on a non-school row
+    service_route_numbers = {}
+    public = coded[~coded["is_school"]]
+    for sc, number in zip(public["code"].tolist(), public["number"].tolist()):
+        service_route_numbers.setdefault(sc, set()).add(number)
+    service_route_numbers = {k: frozenset(v) for k, v in service_route_numbers.items()}
+
+    return {
+        "ROUTES_NORM": routes_norm,
+        "NON_SCHOOL_SERVICES": non_school_services,
+        "PLACE_TO_SERVICES": place_to_services,
+        "SERVICE_TO_PLACES": service_to_places,
+        "SERVICE_PLACE_STAGES": service_place_stages,
+        "ROUTE_NAME_TO_SC": route_name_to_sc,
+        "SC_TO_ROUTE_NAME": sc_to_route_name,
+        "SC_TO_ROUTE_NUMBER": sc_to_route_number,
+        "SERVICE_ROUTE_NUMBERS": service_route_numbers,
+    }
+
+def build_route_faretype_index(parsed_keys_sorted, route_names):
+    """
+    route name -> {fare type as offered in the UI -> PARSED_DATA keys}. Aliased
+    fare types (FARE_TYPE_ALIASES) are grouped under their UI name.
+    """
+    index = {}
+    for route in route_names:
+        by_type = {}
+        for key in route_files_for(parsed_keys_sorted, route):
+            ft = faretype_from_key(route, key)
+            ft = FARE_TYPE_ALIASES.get(ft, ft)
+            if ft:
+                by_type.setdefault(ft, []).append(key)
+        if by_type:
+            index[route] = by_type
+    return index
+
+def store_loaded_data(parsed, routes_df, stops_df):
     st.session_state.PARSED_DATA = parsed or {}
     st.session_state.ROUTES_DF = routes_df
     st.session_state.STOPS_DF = stops_df
-    st.session_state.LIVE_DATA_LOADED = bool(not routes_df.empty and not stops_df.empty)
-    if msg:
-        load_message.info(msg)
-else:
-    load_message.warning("No credentials provided — the app cannot read Drive. Provide a GitHub secret or upload credentials.json.")
-
-# Provide a manual "Load embedded fallback" (if you have embedded base64 strings you can paste them)
-with st.expander("Optional: paste base64(gzip) of Routes/Stops (advanced)"):
-    emb_routes = st.text_area("EMBEDDED_ROUTES_B64 (optional)", value="", height=80)
-    emb_stops = st.text_area("EMBEDDED_STOPS_B64 (optional)", value="", height=80)
-    if st.button("Load embedded Excel fallback"):
-        try:
-            if emb_routes.strip():
-                st.session_state.ROUTES_DF = load_embedded_excel(emb_routes.strip())
-            if emb_stops.strip():
-                st.session_state.STOPS_DF = load_embedded_excel(emb_stops.strip())
-            st.success("Embedded Excel loaded.")
-        except Exception:
-            st.error("Failed to load embedded content.")
+    st.session_state.update(build_lookup_indices(routes_df, stops_df))
+    st.session_state.ROUTE_FARETYPE_KEYS = build_route_faretype_index(
+        sorted(st.session_state.PARSED_DATA), set(st.session_state.ROUTES_NORM["name"]) - {""}
+    )
+    _invalidate_caches()
 
 # --------------------------
-# UI layout: left controls, right results
+# UI & state
 # --------------------------
-left, right = st.columns([1, 1.4])
-with left:
-    st.subheader("Lookup controls")
-    include_schools = st.checkbox("Include school services", value=False)
+def main():
+    st.set_page_config(page_title="NeTEx Fare Finder", layout="wide")
+    st.title("NeTEx Fare Finder — Streamlit edition")
+    st.write("This app downloads `Fares.zip` from your Google Drive (shared with the service account) and provides a fare lookup UI.")
+
+    # Show helpful error if google libs not installed
+    if _google_import_error:
+        st.error(
+            "Google client libraries are not installed in the environment. "
+            "Install: `google-api-python-client google-auth google-auth-httplib2 google-auth-oauthlib requests`"
+        )
+        st.exception(_google_import_error)
+        st.stop()
+
+    # Provide credential input options
+    st.sidebar.header("Authentication")
+    st.sidebar.write(
+        "Preferred: store the **service account JSON** in your GitHub repo secrets as "
+        "`GOOGLE_SERVICE_ACCOUNT` (Streamlit reads `st.secrets`)."
+    )
+    sa_info = None
 
-    # Build route list (filtered)
-    def has_selectable_faretypes(route_name):
+    # Option 1: st.secrets
+    if "GOOGLE_SERVICE_ACCOUNT" in st.secrets:
         try:
-            files = route_files_for(st.session_state.PARSED_DATA, route_name)
-            if not files:
-                return False
-            for k in files:
-                ft = faretype_from_key(route_name, k)
-                if ft and ft.strip():
-                    return True
-            return False
+            sa_info = json.loads(st.secrets["GOOGLE_SERVICE_ACCOUNT"])
+            st.sidebar.success("Using GitHub secret: GOOGLE_SERVICE_ACCOUNT")
         except Exception:
-            return False
-
-    def refresh_route_list():
-        if st.session_state.ROUTES_DF is None or st.session_state.ROUTES_DF.empty or st.session_state.ROUTES_DF.shape[1] < 2:
-            return []
-        all_routes = st.session_state.ROUTES_DF.iloc[:, 1].dropna().astype(str).str.strip().unique()
-        values = []
-        for rn in all_routes:
-            if not include_schools and st.session_state.ROUTES_DF.shape[1] >= 3:
-                matching = st.session_state.ROUTES_DF.loc[st.session_state.ROUTES_DF.iloc[:, 1].astype(str).str.strip() == rn]
-                if not matching.empty:
-                    if str(matching.iloc[0, 2]).strip().lower() == "yes":
-                        continue
-            if not has_selectable_faretypes(rn):
-                continue
-            values.append(rn)
-        return sorted(set(values))
-
-    route_options = refresh_route_list()
-    route_choice = st.selectbox("Select Route (optional)", options=[""] + route_options, index=0)
-
-    st.write("Select Fare Type (optional)")
-    # fare types built later dynamically
-    fare_choice_container = st.empty()
-
-    st.write("Start Place")
-    start_choices = get_all_places_from_stops(st.session_state.STOPS_DF, st.session_state.ROUTES_DF, include_school_services=include_schools)
-    start_choice = st.selectbox("Start place", options=[""] + start_choices, index=0)
-
-    st.write("End Place")
-    # compute end choices dynamically below
-    end_choice_container = st.empty()
-
-    # Stage pickers (only show when needed)
-    start_stage = None
-    end_stage = None
+            st.sidebar.error("Failed to parse st.secrets['GOOGLE_SERVICE_ACCOUNT'] - ensure it contains the raw JSON text.")
+    else:
+        st.sidebar.info("No GitHub secret found (GOOGLE_SERVICE_ACCOUNT). You can upload credentials.json or set an env var.")
+        uploaded = st.sidebar.file_uploader("Upload credentials.json (optional)", type=["json"])
+        if uploaded is not None:
+            try:
+                sa_info = json.load(uploaded)
+                st.sidebar.success("Uploaded credentials.json will be used for this session.")
+            except Exception:
+                st.sidebar.error("Uploaded file is not valid JSON.")
 
-    # Reset button
-    if st.button("Reset"):
-        # clear selections by rerunning with cleared session values
+    # Option: environment variable (useful for other deployments)
+    if sa_info is None and os.environ.get("GOOGLE_SERVICE_ACCOUNT"):
         try:
-            st.session_state.selected_route = ""
-            st.session_state.selected_fare = ""
-            st.session_state.selected_start = ""
-            st.session_state.selected_end = ""
-            st.session_state.selected_start_stage = ""
-            st.session_state.selected_end_stage = ""
+            sa_info = json.loads(os.environ["GOOGLE_SERVICE_ACCOUNT"])
+            st.sidebar.success("Using GOOGLE_SERVICE_ACCOUNT environment variable.")
         except Exception:
-            pass
-        st.experimental_rerun()
-
-with right:
-    st.subheader("Fare result")
-    fare_text = st.empty()
-    other_services_text = st.empty()
-    debug_box = st.expander("Debug / Data summary", expanded=False)
-    with debug_box:
-        st.write("Parsed XML files:", len(st.session_state.PARSED_DATA))
-        st.write("Routes rows:", 0 if st.session_state.ROUTES_DF is None else len(st.session_state.ROUTES_DF))
-        st.write("Stops rows:", 0 if st.session_state.STOPS_DF is None else len(st.session_state.STOPS_DF))
+            st.sidebar.error("Failed to parse GOOGLE_SERVICE_ACCOUNT environment variable.")
+
+    # Load / reload controls
+    reload_button = st.sidebar.button("Reload data from Drive (force)")
+    load_message = st.sidebar.empty()
+
+    @st.cache_data(show_spinner=False)
+    def load_data_from_drive_cached(sa_info_serialized: str, force: bool = False):
+        """
+        sa_info_serialized: json string of service account info. Cached by this string.
+        force: ignore the local parse cache, so the ZIP is downloaded and re-parsed
+        even when its md5 is unchanged.
+        Returns: parsed_data, routes_df, stops_df, message (str)
+        """
+        parsed = {}
+        routes_df = pd.DataFrame()
+        stops_df = pd.DataFrame()
+        msg = ""
 
-# --------------------------
-# Helper: update end choices based on start and route
-# --------------------------
-def compute_end_choices(start, route_name, include_schools_flag):
-    if not start:
-        return []
-    reachable = get_reachable_places(st.session_state.STOPS_DF, start)
-
-    if route_name:
-        sc = route_name_to_service_code(st.session_state.ROUTES_DF, route_name)
-        if sc:
-            p2s, _ = build_place_to_stage_map_for_service(st.session_state.STOPS_DF, sc)
-            route_places = sorted([p for p in p2s.keys() if isinstance(p, str) and p.strip() and p.lower() != "nan"])
-            reachable = [p for p in reachable if p in route_places]
-    else:
         try:
-            sc_col, place_col = st.session_state.STOPS_DF.columns[0], st.session_state.STOPS_DF.columns[7]
-            school_col = st.session_state.ROUTES_DF.columns[2] if st.session_state.ROUTES_DF.shape[1] >= 3 else None
-
-            reachable_filtered = []
-            for place in reachable:
-                services_to_place = st.session_state.STOPS_DF.loc[st.session_state.STOPS_DF[place_col] == place, sc_col].astype(str).unique().tolist()
-                services_from_start = st.session_state.STOPS_DF.loc[st.session_state.STOPS_DF[place_col] == start, sc_col].astype(str).unique().tolist()
-                common_services = set(services_to_place) & set(services_from_start)
-                if not common_services:
-                    continue
-                if school_col:
-                    non_school_services = st.session_state.ROUTES_DF.loc[
-                        st.session_state.ROUTES_DF[st.session_state.ROUTES_DF.columns[0]].astype(str).isin(common_services)
-                        & (st.session_state.ROUTES_DF[school_col].astype(str).str.lower() != "yes")
-                    ]
-                    if not non_school_services.empty:
-                        reachable_filtered.append(place)
-                else:
-                    reachable_filtered.append(place)
-            reachable = sorted(reachable_filtered)
-        except Exception:
-            traceback.print_exc()
+            sa_info = json.loads(sa_info_serialized)
+            service, creds = get_drive_service_from_info(sa_info)
+        except Exception as e:
+            msg = f"Drive authentication failed: {e}"
+            return parsed, routes_df, stops_df, msg
+
+        f = find_file_by_name(service, ZIP_FILE_NAME_ON_DRIVE)
+        if not f:
+            msg = f"'{ZIP_FILE_NAME_ON_DRIVE}' not found on Drive root (or not shared with the service account)."
+            return parsed, routes_df, stops_df, msg
+
+        md5 = f.get("md5Checksum")
+        if not md5:
+            try:
+                md5 = get_file_metadata(service, f["id"]).get("md5Checksum")
+            except Exception:
+                traceback.print_exc()
+        cached = load_parsed_from_cache(md5) if md5 and not force else None
+        if cached is not None:
+            parsed, routes_df, stops_df = cached
+            msg = f"Loaded cached ZIP with {len(parsed)} XML fare files. Routes rows: {len(routes_df)} Stops rows: {len(stops_df)}"
+            return parsed, routes_df, stops_df, msg
 
-    reachable = sorted([p for p in reachable if p != start])
-    return reachable
-
-# compute end choices & fare types & stages & final fare logic
-# We will store current selections in session_state to persist across reruns
-if "selected_route" not in st.session_state:
-    st.session_state.selected_route = ""
-if "selected_fare" not in st.session_state:
-    st.session_state.selected_fare = ""
-if "selected_start" not in st.session_state:
-    st.session_state.selected_start = ""
-if "selected_end" not in st.session_state:
-    st.session_state.selected_end = ""
-if "selected_start_stage" not in st.session_state:
-    st.session_state.selected_start_stage = ""
-if "selected_end_stage" not in st.session_state:
-    st.session_state.selected_end_stage = ""
-
-# sync controls to session state (prefill)
-if route_choice != "" and route_choice != st.session_state.selected_route:
-    st.session_state.selected_route = route_choice
-if start_choice != "" and start_choice != st.session_state.selected_start:
-    st.session_state.selected_start = start_choice
-
-# compute end options
-end_options = compute_end_choices(st.session_state.selected_start, st.session_state.selected_route, include_schools)
-# present end selectbox (in left column container)
-with left:
-    end_choice = end_choice_container.selectbox("End place", options=[""] + end_options, index=0)
-    if end_choice != "" and end_choice != st.session_state.selected_end:
-        st.session_state.selected_end = end_choice
+        try:
+            zip_file = download_file_spooled(creds, f["id"])
+        except Exception as e:
+            msg = f"Failed to download ZIP from Drive: {e}"
+            return parsed, routes_df, stops_df, msg
+
+        with zip_file:
+            parsed, routes_df, stops_df, failed = load_from_fares_zip_bytes(zip_file)
+        # only a complete load is cached; anything partial is retried on the next start
+        if md5 and not routes_df.empty and not stops_df.empty and not failed:
+            save_parsed_to_cache(md5, parsed, routes_df, stops_df)
+        msg = f"Loaded ZIP with {len(parsed)} XML fare files. Routes rows: {len(routes_df)} Stops rows: {len(stops_df)}"
+        if failed:
+            msg += f" ({len(failed)} XML files could not be parsed: {', '.join(failed)})"
+        return parsed, routes_df, stops_df, msg
 
-# populate fare types (similar logic)
-def compute_fare_types():
-    fare_types = set()
-    route_selected = bool(st.session_state.selected_route)
-    start_end_selected = bool(st.session_state.selected_start and st.session_state.selected_end)
-    if not (route_selected or start_end_selected):
-        return []
-    if route_selected:
-        route_name = st.session_state.selected_route
-        files = route_files_for(st.session_state.PARSED_DATA, route_name)
-        for f in files:
-            ft = faretype_from_key(route_name, f)
-            if ft in ("U19 Single", "U19 MySingle", "igo Single"):
-                fare_types.add("U19 Single")
-            elif ft:
-                fare_types.add(ft)
-    else:
-        start, end = st.session_state.selected_start, st.session_state.selected_end
-        if st.session_state.STOPS_DF is None or st.session_state.STOPS_DF.empty:
-            return []
-        sc_col, place_col = st.session_state.STOPS_DF.columns[0], st.session_state.STOPS_DF.columns[7]
-        services_start = set(st.session_state.STOPS_DF.loc[st.session_state.STOPS_DF[place_col] == start, sc_col].astype(str))
-        services_end = set(st.session_state.STOPS_DF.loc[st.session_state.STOPS_DF[place_col] == end, sc_col].astype(str))
-        common_services = services_start & services_end
-        for route_code in common_services:
-            route_name = service_code_to_route_name(st.session_state.ROUTES_DF, route_code)
-            if not route_name:
-                continue
-            files = route_files_for(st.session_state.PARSED_DATA, route_name)
-            for f in files:
-                ft = faretype_from_key(route_name, f)
-                if ft in ("U19 Single", "U19 MySingle", "igo Single"):
-                    fare_types.add("U19 Single")
-                elif ft:
-                    fare_types.add(ft)
-    return sorted(fare_types)
-
-# render fare type control
-with left:
-    fare_types_list = compute_fare_types()
-    if fare_types_list:
-        if st.session_state.selected_fare not in fare_types_list:
-            st.session_state.selected_fare = fare_types_list[0]
-        st.session_state.selected_fare = fare_choice_container.selectbox("Fare type", options=[""] + fare_types_list, index=0 if st.session_state.selected_fare=="" else fare_types_list.index(st.session_state.selected_fare)+1)
+    # container in session state
+    if "PARSED_DATA" not in st.session_state:
+        st.session_state.PARSED_DATA = {}
+    if "ROUTES_DF" not in st.session_state:
+        st.session_state.ROUTES_DF = pd.DataFrame()
+    if "STOPS_DF" not in st.session_state:
+        st.session_state.STOPS_DF = pd.DataFrame()
+    if "LIVE_DATA_LOADED" not in st.session_state:
+        st.session_state.LIVE_DATA_LOADED = False
+    if "SERVICE_ROUTE_NUMBERS" not in st.session_state:
+        st.session_state.update(build_lookup_indices(st.session_state.ROUTES_DF, st.session_state.STOPS_DF))
+    if "ROUTE_FARETYPE_KEYS" not in st.session_state:
+        st.session_state.ROUTE_FARETYPE_KEYS = build_route_faretype_index(
+            sorted(st.session_state.PARSED_DATA), set(st.session_state.ROUTES_NORM["name"]) - {""}
+        )
+
+    # Perform load if sa_info is present
+    if sa_info is not None:
+        # Use a deterministic cache key (stringified JSON)
+        key = json.dumps(sa_info, sort_keys=True)
+        if reload_button:
+            load_data_from_drive_cached.clear()
+        # only (re)load - and rebuild the lookup indices - when the source changes
+        if reload_button or st.session_state.get("LOADED_KEY") != key:
+            parsed, routes_df, stops_df, msg = load_data_from_drive_cached(key, force=reload_button)
+            store_loaded_data(parsed, routes_df, stops_df)
+            st.session_state.LIVE_DATA_LOADED = bool(not routes_df.empty and not stops_df.empty)
+            st.session_state.LOAD_MESSAGE = msg
+            st.session_state.LOADED_KEY = key
+        if st.session_state.LOAD_MESSAGE:
+            load_message.info(st.session_state.LOAD_MESSAGE)
     else:
-        # show empty
+        load_message.warning("No credentials provided — the app cannot read Drive. Provide a GitHub secret or upload credentials.json.")
+
+    # Provide a manual "Load embedded fallback" (if you have embedded base64 strings you can paste them)
+    with st.expander("Optional: paste base64(gzip) of Routes/Stops (advanced)"):
+        emb_routes = st.text_area("EMBEDDED_ROUTES_B64 (optional)", value="", height=80)
+        emb_stops = st.text_area("EMBEDDED_STOPS_B64 (optional)", value="", height=80)
+        if st.button("Load embedded Excel fallback"):
+            try:
+                routes_df, stops_df = st.session_state.ROUTES_DF, st.session_state.STOPS_DF
+                if emb_routes.strip():
+                    routes_df = load_embedded_excel(emb_routes.strip())
+                if emb_stops.strip():
+                    stops_df = load_embedded_excel(emb_stops.strip())
+                store_loaded_data(st.session_state.PARSED_DATA, routes_df, stops_df)
+                st.success("Embedded Excel loaded.")
+            except Exception:
+                st.error("Failed to load embedded content.")
+
+    # --------------------------
+    # UI layout: left controls, right results
+    # --------------------------
+    left, right = st.columns([1, 1.4])
+    with left:
+        st.subheader("Lookup controls")
+        include_schools = st.checkbox("Include school services", value=False)
+
+        def clear_unserved_start():
+            # on_change of both the route and the start place: a start the selected
+            # route doesn't serve is cleared here, before the rerun, instead of being
+            # noticed mid-run and forcing a second run
+            route_name = st.session_state.get("route_choice", "")
+            start = st.session_state.get("start_choice") or st.session_state.get("selected_start", "")
+            if not (route_name and start):
+                return
+            svc = route_name_to_service_code(st.session_state.ROUTE_NAME_TO_SC, route_name)
+            if svc and start not in get_place_to_stage_map(svc):
+                st.session_state.selected_start = ""
+                st.session_state.pop("start_choice", None)
+
+        route_options = get_route_options(include_school_routes=include_schools)
+        route_choice = st.selectbox("Select Route (optional)", options=("",) + route_options, index=0, key="route_choice", on_change=clear_unserved_start)
+
+        st.write("Select Fare Type (optional)")
+        # fare types built later dynamically
+        fare_choice_container = st.empty()
+
+        st.write("Start Place")
+        start_choices = get_all_places_from_stops(include_school_services=include_schools)
+        start_choice = st.selectbox("Start place", options=("",) + start_choices, index=0, key="start_choice", on_change=clear_unserved_start)
+
+        st.write("End Place")
+        # compute end choices dynamically below
+        end_choice_container = st.empty()
+
+        # Stage pickers (only show when needed)
+        start_stage = None
+        end_stage = None
+
+        # Reset button
+        def reset_selections():
+            # runs as a callback, before the rerun, so every selection is cleared
+            # in one go and the page is rendered once with the empty state
+            for name in ("selected_route", "selected_fare", "selected_start", "selected_end"):
+                st.session_state[name] = ""
+            for widget_key in ("route_choice", "start_choice", "end_choice", "selected_start_stage", "selected_end_stage"):
+                st.session_state.pop(widget_key, None)
+
+        st.button("Reset", on_click=reset_selections)
+
+    with right:
+        st.subheader("Fare result")
+        fare_text = st.empty()
+        other_services_text = st.empty()
+        debug_box = st.expander("Debug / Data summary", expanded=False)
+        with debug_box:
+            st.write("Parsed XML files:", len(st.session_state.PARSED_DATA))
+            st.write("Routes rows:", 0 if st.session_state.ROUTES_DF is None else len(st.session_state.ROUTES_DF))
+            st.write("Stops rows:", 0 if st.session_state.STOPS_DF is None else len(st.session_state.STOPS_DF))
+
+    # --------------------------
+    # Helper: update end choices based on start and route
+    # --------------------------
+    @session_cache
+    def compute_end_choices(start, route_name, include_schools_flag):
+        if not start:
+            return ()
+        place_to_services = st.session_state.PLACE_TO_SERVICES
+        # every reachable place already shares a service with start
+        reachable = get_reachable_places(start)
+
+        if route_name:
+            sc = route_name_to_service_code(st.session_state.ROUTE_NAME_TO_SC, route_name)
+            if sc:
+                p2s = get_place_to_stage_map(sc)
+                reachable = tuple(p for p in reachable if p in p2s)
+        elif not include_schools_flag and st.session_state.ROUTES_DF.shape[1] >= 3:
+            # keep places reachable on at least one non-school service
+            services_from_start = place_to_services.get(start, frozenset()) & st.session_state.NON_SCHOOL_SERVICES
+            reachable = tuple(p for p in reachable if place_to_services.get(p, frozenset()) & services_from_start)
+
+        return reachable
+
+    # compute end choices & fare types & stages & final fare logic
+    # We will store current selections in session_state to persist across reruns
+    if "selected_route" not in st.session_state:
+        st.session_state.selected_route = ""
+    if "selected_fare" not in st.session_state:
         st.session_state.selected_fare = ""
-        fare_choice_container.write("Select start and end (or a route) to see available fare types.")
-
-# When route is changed, adjust start place options to service-specific places
-if st.session_state.selected_route:
-    svc = route_name_to_service_code(st.session_state.ROUTES_DF, st.session_state.selected_route)
-    if svc:
-        p2s, _ = build_place_to_stage_map_for_service(st.session_state.STOPS_DF, svc)
-        route_places = sorted([p for p in p2s.keys() if isinstance(p, str) and p.strip() and p.lower() != "nan"])
-        # if the current selected start is not in route_places, clear it
-        if st.session_state.selected_start not in route_places:
-            st.session_state.selected_start = ""
-            # force rerun (will naturally re-render)
-            st.experimental_rerun()
-
-# Evaluate price options based on current state
-def evaluate_price_options():
-    route = st.session_state.selected_route
-    faretype = st.session_state.selected_fare
-    start_place = st.session_state.selected_start
-    end_place = st.session_state.selected_end
-
-    # If start/end set, show other services
-    if start_place and end_place:
-        # compute other services text
-        try:
-            sc_col, place_col = st.session_state.STOPS_DF.columns[0], st.session_state.STOPS_DF.columns[7]
-            services_start = set(st.session_state.STOPS_DF.loc[st.session_state.STOPS_DF[place_col] == start_place, sc_col].astype(str))
-            services_end = set(st.session_state.STOPS_DF.loc[st.session_state.STOPS_DF[place_col] == end_place, sc_col].astype(str))
-            common_services = services_start & services_end
-        except Exception:
-            common_services = set()
+    if "selected_start" not in st.session_state:
+        st.session_state.selected_start = ""
+    if "selected_end" not in st.session_state:
+        st.session_state.selected_end = ""
+    if "selected_start_stage" not in st.session_state:
+        st.session_state.selected_start_stage = ""
+    if "selected_end_stage" not in st.session_state:
+        st.session_state.selected_end_stage = ""
+
+    # sync controls to session state (prefill)
+    if route_choice != "" and route_choice != st.session_state.selected_route:
+        st.session_state.selected_route = route_choice
+    if start_choice != "" and start_choice != st.session_state.selected_start:
+        st.session_state.selected_start = start_choice
+
+    # compute end options
+    end_options = compute_end_choices(st.session_state.selected_start, st.session_state.selected_route, include_schools)
+    # present end selectbox (in left column container)
+    with left:
+        end_choice = end_choice_container.selectbox("End place", options=("",) + end_options, index=0, key="end_choice")
+        if end_choice != "" and end_choice != st.session_state.selected_end:
+            st.session_state.selected_end = end_choice
+
+    # populate fare types (similar logic)
+    @session_cache
+    def compute_fare_types(route, start, end):
+        fare_types = set()
+        if not (route or (start and end)):
+            return ()
+        route_faretype_keys = st.session_state.ROUTE_FARETYPE_KEYS
+        if route:
+            fare_types.update(route_faretype_keys.get(route, {}))
+        else:
+            place_to_services = st.session_state.PLACE_TO_SERVICES
+            sc_to_route_name = st.session_state.SC_TO_ROUTE_NAME
+            common_services = place_to_services.get(start, frozenset()) & place_to_services.get(end, frozenset())
+            for route_code in common_services:
+                route_name = service_code_to_route_name(sc_to_route_name, route_code)
+                if not route_name:
+                    continue
+                fare_types.update(route_faretype_keys.get(route_name, {}))
+        return tuple(sorted(fare_types))
 
-        if not common_services:
-            other_services_text.empty()
+    # render fare type control
+    with left:
+        fare_types_list = compute_fare_types(
+            st.session_state.selected_route, st.session_state.selected_start, st.session_state.selected_end
+        )
+        if fare_types_list:
+            selected_fare = st.session_state.selected_fare
+            if selected_fare not in fare_types_list:
+                selected_fare = fare_types_list[0]
+            st.session_state.selected_fare = fare_choice_container.selectbox("Fare type", options=("",) + fare_types_list, index=0 if selected_fare=="" else fare_types_list.index(selected_fare)+1)
         else:
-            route_codes = st.session_state.ROUTES_DF.iloc[:, 0].astype(str) if st.session_state.ROUTES_DF is not None else pd.Series([])
-            school_flags = st.session_state.ROUTES_DF.iloc[:, 2].astype(str).str.lower() if (st.session_state.ROUTES_DF is not None and st.session_state.ROUTES_DF.shape[1] >= 3) else pd.Series([""] * len(st.session_state.ROUTES_DF))
-            current_route = route
-            exclude_9 = bool(current_route)
-            mask = st.session_state.ROUTES_DF[st.session_state.ROUTES_DF.columns[0]].astype(str).isin(common_services) & (school_flags != "yes")
-            if exclude_9:
-                mask = mask & (~st.session_state.ROUTES_DF.iloc[:, 0].astype(str).str.startswith("9"))
-
-            if st.session_state.ROUTES_DF.shape[1] >= 4:
-                route_numbers = st.session_state.ROUTES_DF.loc[mask, st.session_state.ROUTES_DF.columns[3]].astype(str).tolist()
-            elif st.session_state.ROUTES_DF.shape[1] >= 2:
-                route_numbers = st.session_state.ROUTES_DF.loc[mask, st.session_state.ROUTES_DF.columns[1]].astype(str).tolist()
-            else:
-                route_numbers = [str(r) for r in sorted(common_services)]
+            # show empty
+            st.session_state.selected_fare = ""
+            fare_choice_container.write("Select start and end (or a route) to see available fare types.")
+
+    # Services shown alongside the fare; only recomputed when the places or route change
+    @session_cache
+    def get_other_service_numbers(start_place, end_place, current_route):
+        place_to_services = st.session_state.PLACE_TO_SERVICES
+        common_services = place_to_services.get(start_place, frozenset()) & place_to_services.get(end_place, frozenset())
+        if not common_services:
+            return ()
 
+        # "number" is the Route number column, or the route name on narrower sheets
+        if st.session_state.ROUTES_DF.shape[1] >= 2:
             if current_route:
-                current_service_code = route_name_to_service_code(st.session_state.ROUTES_DF, current_route)
-                if current_service_code is not None and st.session_state.ROUTES_DF.shape[1] >= 1:
-                    current_number = st.session_state.ROUTES_DF.loc[
-                        st.session_state.ROUTES_DF.iloc[:, 0].astype(str) == str(current_service_code),
-                        st.session_state.ROUTES_DF.columns[3] if st.session_state.ROUTES_DF.shape[1] >= 4 else st.session_state.ROUTES_DF.columns[1]
-                    ].values
-                    if len(current_number):
-                        route_numbers = [r for r in route_numbers if r != str(current_number[0])]
-            route_numbers = sorted(set(route_numbers))
+                common_services = [sc for sc in common_services if not sc.startswith("9")]
+            service_route_numbers = st.session_state.SERVICE_ROUTE_NUMBERS
+            route_numbers = set().union(*(service_route_numbers.get(sc, ()) for sc in common_services))
+        else:
+            route_numbers = set(common_services)
+
+        if current_route:
+            current_service_code = route_name_to_service_code(st.session_state.ROUTE_NAME_TO_SC, current_route)
+            sc_to_route_number = st.session_state.SC_TO_ROUTE_NUMBER
+            if current_service_code in sc_to_route_number:
+                current_number = sc_to_route_number[current_service_code]
+                route_numbers.discard(current_number)
+        return tuple(sorted(route_numbers))
+
+    # Price lookup for the current selections; the stage pickers are rendered from its result
+    @session_cache
+    def get_price_options(route, faretype, start_place, end_place):
+        """
+        One of ("error", message), ("fare", price), ("multiple", sorted prices) or
+        ("stages", (start_candidates, end_candidates, partners, name_to_id)), where a
+        candidate tuple is empty when that side needs no stage choice. Cached so
+        that reruns which only change a stage picker reuse it.
+        """
+        # collect the parsed files holding the chosen fare type
+        route_faretype_keys = st.session_state.ROUTE_FARETYPE_KEYS
+        if route:
+            matched = list(route_faretype_keys.get(route, {}).get(faretype, ()))
+            if not matched:
+                return "error", "No fare files found for this route."
+        else:
+            # route not selected; find common services and aggregate
+            place_to_services = st.session_state.PLACE_TO_SERVICES
+            common_services = place_to_services.get(start_place, frozenset()) & place_to_services.get(end_place, frozenset())
+
+            if not common_services:
+                return "error", "No services serve both places."
+
+            matched = []
+            sc_to_route_name = st.session_state.SC_TO_ROUTE_NAME
+            for svc in common_services:
+                route_name = service_code_to_route_name(sc_to_route_name, svc)
+                if not route_name:
+                    continue
+                matched.extend(route_faretype_keys.get(route_name, {}).get(faretype, ()))
+
+        # prepare zone_lookup, fares, name_to_id aggregated across matched files
+        zl, fdict, n2i, partners = get_merged_fare_tables(tuple(matched))
+
+        # Now compute stages lists
+        if route:
+            sc = route_name_to_service_code(st.session_state.ROUTE_NAME_TO_SC, route)
+            if not sc:
+                return "error", "Service code not found."
+            p2s = get_place_to_stage_map(sc)
+            start_stages, end_stages = p2s.get(start_place, []), p2s.get(end_place, [])
+        else:
+            by_service = st.session_state.SERVICE_PLACE_STAGES
+            p2s_list = [by_service.get(svc, {}) for svc in common_services]
+            start_stages = sorted(set().union(*(p2s.get(start_place, ()) for p2s in p2s_list)))
+            end_stages = sorted(set().union(*(p2s.get(end_place, ()) for p2s in p2s_list)))
+
+        # (stage name, zone id) for the stages the fare files know about
+        start_pairs = [(n, i) for n in start_stages if (i := n2i.get(n))]
+        end_pairs = [(n, i) for n in end_stages if (i := n2i.get(n))]
+        start_ids = [i for _, i in start_pairs]
+        end_ids = [i for _, i in end_pairs]
+
+        if not start_ids or not end_ids:
+            return "error", "No matching stages."
+
+        # walk each start zone's priced partners rather than probing every start x end pair
+        end_id_set = set(end_ids)
+        pm = {(s, e): p for s in start_ids for e, p in partners.get(s, {}).items() if e in end_id_set}
+
+        if not pm:
+            return "error", "No fare found."
+        # usually every pair costs the same, so settle that before collecting distinct prices
+        lowest, highest = min(pm.values()), max(pm.values())
+        if lowest == highest:
+            return "fare", lowest
+
+        # multiple prices - may need stage selection
+        # fares are looked up in both directions, so a stage has a priced
+        # partner exactly when its zone appears on its own side of pm
+        pm_starts = {s for s, _ in pm}
+        pm_ends = {e for _, e in pm}
+        # start/end stages are already sorted, so the candidates keep that order
+        start_candidates = tuple(name for name, i in start_pairs if i in pm_starts)
+        end_candidates = tuple(name for name, i in end_pairs if i in pm_ends)
+
+        if len(start_stages) <= 1 or len(start_candidates) <= 1:
+            start_candidates = ()
+        if len(end_stages) <= 1 or len(end_candidates) <= 1:
+            end_candidates = ()
+
+        if not start_candidates and not end_candidates:
+            return "multiple", tuple(sorted(set(pm.values())))
+        return "stages", (start_candidates, end_candidates, partners, n2i)
+
+    # Evaluate price options based on current state
+    def evaluate_price_options():
+        route = st.session_state.selected_route
+        faretype = st.session_state.selected_fare
+        start_place = st.session_state.selected_start
+        end_place = st.session_state.selected_end
+
+        # If start/end set, show other services
+        if start_place and end_place:
+            route_numbers = get_other_service_numbers(start_place, end_place, route)
             if route_numbers:
-                prefix = "Other services between these places: " if current_route else "Services between these places: "
+                prefix = "Other services between these places: " if route else "Services between these places: "
                 other_services_text.info(prefix + ", ".join(route_numbers))
             else:
                 other_services_text.empty()
-    else:
-        other_services_text.empty()
-
-    # Fare computation
-    if not (faretype and start_place and end_place):
-        if start_place and end_place:
-            fare_text.info("Select route or fare type to display fare.")
         else:
-            fare_text.info("Select route and fare type, then places")
-        return
+            other_services_text.empty()
 
-    # prepare zone_lookup, fares, name_to_id aggregated across matched files
-    zl, fdict, n2i = {}, {}, {}
-    if route:
-        matched = []
-        for k in route_files_for(st.session_state.PARSED_DATA, route):
-            ft = faretype_from_key(route, k)
-            if faretype == "U19 Single" and ft in ("U19 Single", "U19 MySingle", "igo Single"):
-                matched.append(k)
-            elif ft == faretype:
-                matched.append(k)
-        if not matched:
-            fare_text.error("No fare files found for this route.")
+        # Fare computation
+        if not (faretype and start_place and end_place):
+            if start_place and end_place:
+                fare_text.info("Select route or fare type to display fare.")
+            else:
+                fare_text.info("Select route and fare type, then places")
             return
-        for key in matched:
-            entry = st.session_state.PARSED_DATA.get(key, {})
-            for zid, zname in entry.get("zone_lookup", {}).items():
-                zl.setdefault(zid, zname)
-                n2i.setdefault(zname, zid)
-            for pair, price in entry.get("fares", {}).items():
-                fdict.setdefault(pair, price)
-    else:
-        # route not selected; find common services and aggregate
-        try:
-            sc_col, place_col = st.session_state.STOPS_DF.columns[0], st.session_state.STOPS_DF.columns[7]
-            services_start = set(st.session_state.STOPS_DF.loc[st.session_state.STOPS_DF[place_col] == start_place, sc_col].astype(str))
-            services_end = set(st.session_state.STOPS_DF.loc[st.session_state.STOPS_DF[place_col] == end_place, sc_col].astype(str))
-            common_services = services_start & services_end
-        except Exception:
-            common_services = set()
 
-        if not common_services:
-            fare_text.error("No services serve both places.")
+        kind, result = get_price_options(route, faretype, start_place, end_place)
+        if kind == "error":
+            fare_text.error(result)
             return
-
-        for svc in common_services:
-            route_name = service_code_to_route_name(st.session_state.ROUTES_DF, svc)
-            if not route_name:
-                continue
-            for key in route_files_for(st.session_state.PARSED_DATA, route_name):
-                ft = faretype_from_key(route_name, key)
-                matched_key = None
-                if faretype == "U19 Single" and ft in ("U19 Single", "U19 MySingle", "igo Single"):
-                    matched_key = key
-                elif ft == faretype:
-                    matched_key = key
-                if matched_key:
-                    entry = st.session_state.PARSED_DATA.get(matched_key, {})
-                    for zid, zname in entry.get("zone_lookup", {}).items():
-                        zl.setdefault(zid, zname)
-                        n2i.setdefault(zname, zid)
-                    for pair, price in entry.get("fares", {}).items():
-                        fdict.setdefault(pair, price)
-
-    # Now compute stages lists
-    if route:
-        sc = route_name_to_service_code(st.session_state.ROUTES_DF, route)
-        if not sc:
-            fare_text.error("Service code not found.")
+        if kind == "fare":
+            fare_text.success(format_price(result))
             return
-        p2s, _ = build_place_to_stage_map_for_service(st.session_state.STOPS_DF, sc)
-        start_stages, end_stages = p2s.get(start_place, []), p2s.get(end_place, [])
-    else:
-        start_stages_set, end_stages_set = set(), set()
-        for svc in common_services:
-            p2s, _ = build_place_to_stage_map_for_service(st.session_state.STOPS_DF, svc)
-            start_stages_set.update(p2s.get(start_place, []))
-            end_stages_set.update(p2s.get(end_place, []))
-        start_stages, end_stages = sorted(start_stages_set), sorted(end_stages_set)
-
-    start_ids = [n2i.get(n) for n in start_stages if n2i.get(n)]
-    end_ids = [n2i.get(n) for n in end_stages if n2i.get(n)]
-
-    if not start_ids or not end_ids:
-        fare_text.error("No matching stages.")
-        return
-
-    prices, pm = set(), {}
-    for s in start_ids:
-        for e in end_ids:
-            p = fdict.get((s, e)) or fdict.get((e, s))
-            if p:
-                prices.add(p)
-                pm[(s, e)] = p
-
-    if not prices:
-        fare_text.error("No fare found.")
-        return
-    elif len(prices) == 1:
-        fare_text.success(f"£{list(prices)[0]}")
-        return
-    else:
-        # multiple prices - may need stage selection
-        show_start_stage = len(start_stages) > 1
-        show_end_stage = len(end_stages) > 1
-
-        start_candidates = [name for name in start_stages if n2i.get(name) and any((n2i.get(name), e) in pm or (e, n2i.get(name)) in pm for e in end_ids)]
-        end_candidates = [name for name in end_stages if n2i.get(name) and any((s, n2i.get(name)) in pm or (n2i.get(name), s) in pm for s in start_ids)]
-
-        if len(start_candidates) <= 1:
-            show_start_stage = False
-        if len(end_candidates) <= 1:
-            show_end_stage = False
-
-        if not show_start_stage and not show_end_stage:
-            fare_text.warning("Multiple fares: " + ", ".join(sorted(prices)))
+        if kind == "multiple":
+            fare_text.warning("Multiple fares: " + ", ".join(f"{p:.2f}" for p in result))
             return
-        else:
-            # show selection widgets in the UI (right-side)
-            with st.expander("Resolve multiple fares by selecting stages", expanded=True):
-                if show_start_stage:
-                    ss = st.selectbox("Choose start stage", options=[""] + sorted(start_candidates), index=0, key="selected_start_stage")
-                else:
-                    ss = ""
-                if show_end_stage:
-                    es = st.selectbox("Choose end stage", options=[""] + sorted(end_candidates), index=0, key="selected_end_stage")
-                else:
-                    es = ""
-                # when both selected, lookup specific price
-                if ((not show_start_stage) or ss) and ((not show_end_stage) or es):
-                    s_ids_local = [n2i.get(ss)] if ss and n2i.get(ss) else []
-                    e_ids_local = [n2i.get(es)] if es and n2i.get(es) else []
-                    if s_ids_local and e_ids_local:
-                        for s in s_ids_local:
-                            for e in e_ids_local:
-                                p = fdict.get((s, e)) or fdict.get((e, s))
-                                if p:
-                                    fare_text.success(f"£{p}")
-                                    return
-                        fare_text.error("No fare found for selected stages.")
+
+        start_candidates, end_candidates, partners, n2i = result
+        show_start_stage = bool(start_candidates)
+        show_end_stage = bool(end_candidates)
+        # show selection widgets in the UI (right-side)
+        with st.expander("Resolve multiple fares by selecting stages", expanded=True):
+            if show_start_stage:
+                ss = st.selectbox("Choose start stage", options=("",) + start_candidates, index=0, key="selected_start_stage")
+            else:
+                ss = ""
+            if show_end_stage:
+                es = st.selectbox("Choose end stage", options=("",) + end_candidates, index=0, key="selected_end_stage")
+            else:
+                es = ""
+            # when both selected, lookup specific price
+            if ((not show_start_stage) or ss) and ((not show_end_stage) or es):
+                s_id = n2i.get(ss) if ss else None
+                e_id = n2i.get(es) if es else None
+                if s_id and e_id:
+                    p = partners.get(s_id, {}).get(e_id)
+                    if p is not None:
+                        fare_text.success(format_price(p))
                         return
-            fare_text.info("Multiple fares found - select specific stage(s) to resolve.")
-            return
+                    fare_text.error("No fare found for selected stages.")
+                    return
+        fare_text.info("Multiple fares found - select specific stage(s) to resolve.")
+
+    # Trigger fare evaluation whenever selections change
+    # First sync session selections from controls (left column)
+    # route_choice, start_choice, end_choice and fare_choice_container control already updated session_state above
+    # set selected_* from available local variables (if empty keep existing)
+    if route_choice != "":
+        st.session_state.selected_route = route_choice
+    else:
+        # if user cleared route choice in selectbox (selected ""), clear stored route
+        st.session_state.selected_route = ""
 
-# Trigger fare evaluation whenever selections change
-# First sync session selections from controls (left column)
-# route_choice, start_choice, end_choice and fare_choice_container control already updated session_state above
-# set selected_* from available local variables (if empty keep existing)
-if route_choice != "":
-    st.session_state.selected_route = route_choice
-else:
-    # if user cleared route choice in selectbox (selected ""), clear stored route
-    st.session_state.selected_route = ""
+    if start_choice != "":
+        st.session_state.selected_start = start_choice
 
-if start_choice != "":
-    st.session_state.selected_start = start_choice
+    if end_choice != "":
+        st.session_state.selected_end = end_choice
 
-if end_choice != "":
-    st.session_state.selected_end = end_choice
+    # selected fare value (if rendered)
+    if fare_types_list:
+        # obtain the current selected from the widget (via session_state key set earlier)
+        # the widget stored value in st.session_state when we created it by using the selectbox with no explicit key
+        # we find it at 'Fare type' label? To avoid ambiguity, we just ensure session_state.selected_fare is set to the computed first item if empty
+        if st.session_state.selected_fare == "" and fare_types_list:
+            st.session_state.selected_fare = fare_types_list[0]
 
-# selected fare value (if rendered)
-if fare_types_list:
-    # obtain the current selected from the widget (via session_state key set earlier)
-    # the widget stored value in st.session_state when we created it by using the selectbox with no explicit key
-    # we find it at 'Fare type' label? To avoid ambiguity, we just ensure session_state.selected_fare is set to the computed first item if empty
-    if st.session_state.selected_fare == "" and fare_types_list:
-        st.session_state.selected_fare = fare_types_list[0]
+    # Evaluate and show results
+    evaluate_price_options()
 
-# Evaluate and show results
-evaluate_price_options()
+# Streamlit runs this script as "__main__"; parser workers re-run it as
+# "__mp_main__" and must only get the definitions above
+if __name__ == "__main__":
+    main()
 
 # end of app
 
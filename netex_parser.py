@@ -0,0 +1,152 @@
+# NeTEx fare file parsing, kept out of the Streamlit script so that parser
+# worker processes can import it on its own
+import io
+import sys
+import traceback
+import xml.etree.ElementTree as ET
+from typing import Dict, Tuple
+
+# lxml gives a C-level streaming parser; fall back to the stdlib one if missing
+try:
+    from lxml import etree as LET
+except ImportError:
+    LET = None
+
+NETEX_NS = "http://www.netex.org.uk/netex"
+# tags of elements in the NeTEx namespace start with this
+NETEX_TAG_PREFIX = f"{{{NETEX_NS}}}"
+FARE_ZONE_TAG = f"{{{NETEX_NS}}}FareZone"
+PRICE_GROUP_TAG = f"{{{NETEX_NS}}}PriceGroup"
+DISTANCE_MATRIX_ELEMENT_TAG = f"{{{NETEX_NS}}}DistanceMatrixElement"
+# child lookups used by parse_netex, built once rather than per element
+NAME_PATH = f"{{{NETEX_NS}}}Name"
+START_ZONE_REF_PATH = f"{{{NETEX_NS}}}StartTariffZoneRef"
+END_ZONE_REF_PATH = f"{{{NETEX_NS}}}EndTariffZoneRef"
+PRICE_GROUP_REF_PATH = f"{{{NETEX_NS}}}priceGroups/{{{NETEX_NS}}}PriceGroupRef"
+PRICE_AMOUNT_PATH = f".//{{{NETEX_NS}}}GeographicalIntervalPrice/{{{NETEX_NS}}}Amount"
+PRICE_AMOUNT_XPATH = (
+    LET.XPath(".//n:GeographicalIntervalPrice/n:Amount", namespaces={"n": NETEX_NS})
+    if LET is not None else None
+)
+
+# --------------------------
+# NETEX parsing (same logic as your script)
+# --------------------------
+def parse_netex(xml_path_or_filelike) -> Tuple[Dict[str, str], Dict[tuple, float]]:
+    if isinstance(xml_path_or_filelike, (bytes, bytearray)):
+        xml_path_or_filelike = io.BytesIO(xml_path_or_filelike)
+    if LET is None:
+        return _parse_netex_etree(xml_path_or_filelike)
+
+    zone_lookup = {}
+    price_lookup = {}
+    # DistanceMatrixElement refs, kept column-wise
+    starts, ends, price_refs = [], [], []
+
+    # single streaming pass: only the three element types we care about are
+    # surfaced, and each is freed (with its preceding siblings) once read
+    for _, elem in LET.iterparse(
+        xml_path_or_filelike,
+        events=("end",),
+        tag=(FARE_ZONE_TAG, PRICE_GROUP_TAG, DISTANCE_MATRIX_ELEMENT_TAG),
+    ):
+        tag = elem.tag
+        if tag == DISTANCE_MATRIX_ELEMENT_TAG:
+            start_elem = elem.find(START_ZONE_REF_PATH)
+            end_elem = elem.find(END_ZONE_REF_PATH)
+            price_ref_elem = elem.find(PRICE_GROUP_REF_PATH)
+            if start_elem is not None and end_elem is not None and price_ref_elem is not None:
+                start = start_elem.get("ref")
+                end = end_elem.get("ref")
+                if start and end:
+                    # PriceGroups may come after the matrix, so resolve refs at the end
+                    starts.append(sys.intern(start))
+                    ends.append(sys.intern(end))
+                    price_refs.append(price_ref_elem.get("ref"))
+        elif tag == FARE_ZONE_TAG:
+            fz_id = elem.get("id")
+            name_elem = elem.find(NAME_PATH)
+            if fz_id and name_elem is not None and name_elem.text:
+                zone_lookup[sys.intern(fz_id)] = sys.intern(name_elem.text.strip())
+        else:
+            pg_id = elem.get("id")
+            amounts = PRICE_AMOUNT_XPATH(elem)
+            amount_elem = amounts[0] if amounts else None
+            if pg_id and amount_elem is not None and amount_elem.text:
+                try:
+                    price_lookup[pg_id] = round(float(amount_elem.text.strip()), 2)
+                except Exception:
+                    pass
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+    prices = map(price_lookup.get, price_refs)
+    fares = {pair: price for pair, price in zip(zip(starts, ends), prices) if price is not None}
+    return zone_lookup, fares
+
+def _parse_netex_etree(xml_path_or_filelike) -> Tuple[Dict[str, str], Dict[tuple, float]]:
+    # stdlib fallback used when lxml is not installed
+    root = ET.parse(xml_path_or_filelike).getroot()
+
+    zone_lookup = {}
+    price_lookup = {}
+    dme_elems = []
+    # one walk over the tree; DistanceMatrixElements are resolved once every
+    # PriceGroup has been seen
+    for elem in root.iter():
+        tag = elem.tag
+        if tag == DISTANCE_MATRIX_ELEMENT_TAG:
+            dme_elems.append(elem)
+        elif tag == FARE_ZONE_TAG:
+            fz_id = elem.attrib.get("id")
+            name_elem = elem.find(NAME_PATH)
+            if fz_id and name_elem is not None and name_elem.text:
+                zone_lookup[sys.intern(fz_id)] = sys.intern(name_elem.text.strip())
+        elif tag == PRICE_GROUP_TAG:
+            pg_id = elem.attrib.get("id")
+            amount_elem = elem.find(PRICE_AMOUNT_PATH)
+            if pg_id and amount_elem is not None and amount_elem.text:
+                try:
+                    price_lookup[pg_id] = round(float(amount_elem.text.strip()), 2)
+                except Exception:
+                    continue
+
+    fares = {}
+    for dme in dme_elems:
+        start_elem = dme.find(START_ZONE_REF_PATH)
+        end_elem = dme.find(END_ZONE_REF_PATH)
+        price_ref_elem = dme.find(PRICE_GROUP_REF_PATH)
+        if start_elem is None or end_elem is None or price_ref_elem is None:
+            continue
+        start = start_elem.attrib.get("ref")
+        end = end_elem.attrib.get("ref")
+        price_ref = price_ref_elem.attrib.get("ref")
+        price = price_lookup.get(price_ref)
+        if start and end and price is not None:
+            fares[(sys.intern(start), sys.intern(end))] = price
+    return zone_lookup, fares
+
+# returned in place of a result by members that failed to read or parse;
+# a plain string so that it survives the trip back from a worker process
+PARSE_FAILED = "parse failed"
+
+def _parse_one(data):
+    # top-level so it can be shipped to worker processes; a bad file must not
+    # take the rest of the batch down with it
+    if data is None:
+        return None
+    try:
+        return parse_netex(data)
+    except Exception:
+        traceback.print_exc()
+        return PARSE_FAILED
+
+def _root_tag(fh):
+    # stops at the root's start event, however long the prolog/comments before it
+    try:
+        for _, elem in (LET or ET).iterparse(fh, events=("start",)):
+            return elem.tag
+    except Exception:
+        pass
+    return None